@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
 
 from collections import namedtuple
+import functools
+import threading
 import cv2
 import numpy as np
-import math
 
 
 IntermediateImageSet = namedtuple(
@@ -12,16 +13,107 @@ IntermediateImageSet = namedtuple(
      "centre_points"]
 )
 
+# Columns of the (N, 4) arrays lines are stored in
+_RHO, _THETA, _COS_THETA, _SIN_THETA = range(4)
 
-def scan(cube_image):
+# Angle resolution of the Hough transform accumulator
+_HOUGH_THETA_RESOLUTION = np.pi/180
+
+# Bounds on theta for lines within 1/36pi of horizontal and of vertical
+_HORIZONTAL_THETA_LOW = np.pi*17/36
+_HORIZONTAL_THETA_HIGH = np.pi*19/36
+_VERTICAL_THETA_LOW = -np.pi/36
+_VERTICAL_THETA_HIGH = np.pi/36
+
+# Half width of the square around each centre point its colour is sampled
+# from
+_SAMPLE_OFFSET = 20
+
+# Furthest centre points may move when treating nearly axis aligned lines as
+# exactly so, small enough that the sampled square stays on the sticker
+_AXIS_ALIGNED_MAX_ERROR = _SAMPLE_OFFSET/2
+
+# Maximum difference between rhos of parallel lines for them to be similar
+_RHO_THRESHOLD = 50
+
+# Rubik's cube colours and their BGR values as seen by the camera
+_PALETTE_NAMES = ('white', 'green', 'red', 'blue', 'orange', 'yellow')
+_PALETTE = np.array([
+    (255, 255, 255),
+    (72, 155, 0),
+    (52, 18, 183),
+    (173, 70, 0),
+    (0, 88, 255),
+    (0, 213, 255)
+], dtype=np.int16)
+
+
+def scan(cube_image, debug_steps=frozenset()):
     """Scan the given cube image and return the colours of the cube face.
 
     Returns tuple (colours, intermediate images) where colours is a tuple
     of scanned colours and intermediate images are images generated through
-    the scanning process to be used for debugging.
+    the scanning process to be used for debugging. Only the intermediate
+    images named in debug_steps, by their IntermediateImageSet field, are
+    generated and the rest are None. Intermediate images are None if no
+    steps are given.
+
+    Work buffers are kept between scans of the same image size, one set per
+    thread, so scans from several threads at once are safe.
     """
-    edge_image = _detect_edges(cube_image)
-    lines = _detect_lines(edge_image)
+    if cube_image.dtype != np.uint8:
+        raise ValueError(
+            f"Cube image must be 8-bit BGR, not {cube_image.dtype}"
+        )
+
+    unknown_steps = set(debug_steps) - set(IntermediateImageSet._fields)
+    if unknown_steps:
+        raise ValueError(f"Unknown debug steps: {sorted(unknown_steps)}")
+
+    height, width = cube_image.shape[:2]
+    return _compile_scan(height, width)(cube_image, debug_steps)
+
+
+@functools.lru_cache(maxsize=4)
+def _compile_scan(height, width):
+    """Returns a scan function specialised to images of the given size.
+
+    Work buffers and settings that depend on the image size are set up once
+    here, as repeated scans such as from a camera are all the same size.
+    """
+    # OpenCV releases the GIL, so each thread needs its own buffers or
+    # concurrent scans would overwrite one another's images
+    thread_buffers = threading.local()
+    # Segments must be at least around half a square's edge long
+    min_line_length = min(height, width)//6
+    # Treating centre lines tilted by up to this angle as axis aligned moves
+    # centre points by at most around tan(tilt) * (height + width)
+    axis_aligned_tolerance = np.arctan(
+        _AXIS_ALIGNED_MAX_ERROR / (height + width)
+    )
+
+    def work_buffers():
+        """Returns this thread's gray and blurred gray work buffers."""
+        if not hasattr(thread_buffers, "images"):
+            thread_buffers.images = (
+                np.empty((height, width), dtype=np.uint8),
+                np.empty((height, width), dtype=np.uint8)
+            )
+        return thread_buffers.images
+
+    return functools.partial(
+        _scan,
+        work_buffers=work_buffers,
+        min_line_length=min_line_length,
+        axis_aligned_tolerance=axis_aligned_tolerance
+    )
+
+
+def _scan(cube_image, debug_steps, work_buffers, min_line_length,
+          axis_aligned_tolerance):
+    """Scans the cube image using the given work buffers and settings."""
+    edge_image = _detect_edges(cube_image, work_buffers)
+    lines = _detect_lines(edge_image, min_line_length)
     orthogonal_lines = _horizontal_and_vertical_lines(lines)
 
     combined_lines = _combine_lines(orthogonal_lines)
@@ -32,216 +124,283 @@ def scan(cube_image):
     if centre_lines is None:
         return None
 
-    centre_points = _find_centres(centre_lines)
+    centre_points = _find_centres(centre_lines, axis_aligned_tolerance)
+    if centre_points is None:
+        return None
 
     square_colours = _square_colours(cube_image, centre_points)
-    rubiks_colours = [_to_rubiks_colour(colour) for colour in square_colours]
-
-    intermediate_images = IntermediateImageSet(
-        edges=edge_image,
-        lines=_draw_lines(cube_image, lines),
-        orthogonal_lines=_draw_lines(cube_image, orthogonal_lines),
-        combined_lines=_draw_lines(cube_image, combined_lines),
-        centre_lines=_draw_lines(
-            cube_image,
-            (line for line_group in centre_lines for line in line_group)
+    if square_colours is None:
+        return None
+
+    rubiks_colours = _to_rubiks_colours(square_colours)
+
+    if not debug_steps:
+        return rubiks_colours, None
+
+    # Only draw the images asked for, as each is a full copy of the image
+    image_generators = {
+        "edges": lambda: _to_array(edge_image),
+        "lines": lambda: _draw_lines(cube_image, lines),
+        "orthogonal_lines": lambda: _draw_lines(cube_image, orthogonal_lines),
+        "combined_lines": lambda: _draw_lines(cube_image, combined_lines),
+        "centre_lines": lambda: _draw_lines(
+            cube_image, np.concatenate(centre_lines)
         ),
-        centre_points=_draw_points(cube_image, centre_points)
-    )
+        "centre_points": lambda: _draw_points(cube_image, centre_points)
+    }
+    intermediate_images = IntermediateImageSet(**{
+        step: generate_image() if step in debug_steps else None
+        for step, generate_image in image_generators.items()
+    })
 
     return rubiks_colours, intermediate_images
 
 
-def _detect_edges(image):
-    """Detects edges in the given image using Canny edge detection."""
-    gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    blurred_gray_image = cv2.GaussianBlur(gray_image, (5, 5), 0)
+def _to_array(image):
+    """Returns the image as a NumPy array, downloading it from the OpenCL
+    device if necessary.
+    """
+    if isinstance(image, cv2.UMat):
+        return image.get()
+
+    return image
+
+
+def _detect_edges(image, work_buffers):
+    """Detects edges in the given image using Canny edge detection.
+
+    work_buffers returns the gray and blurred gray single channel work
+    buffers the size of the image. Runs on the OpenCL device instead if
+    OpenCV has one available, in which case the edge image is left on the
+    device as a cv2.UMat and no work buffers are needed.
+    """
+    if cv2.ocl.useOpenCL():
+        # OpenCV pools OpenCL buffers itself
+        gray_umat = cv2.cvtColor(cv2.UMat(image), cv2.COLOR_BGR2GRAY)
+        blurred_gray_umat = cv2.GaussianBlur(gray_umat, (5, 5), 0)
+        return cv2.Canny(blurred_gray_umat, 0, 50)
+
+    gray_image, blurred_gray_image = work_buffers()
+
+    # Use the images returned, as OpenCV writes to a new image instead if a
+    # buffer does not match
+    gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=gray_image)
+    blurred_gray_image = cv2.GaussianBlur(
+        gray_image, (5, 5), 0, dst=blurred_gray_image
+    )
+    # Edge image is kept in the intermediate images so is not reused
     edge_image = cv2.Canny(blurred_gray_image, 0, 50)
 
     return edge_image
 
 
-def _detect_lines(edge_image, threshold=125):
-    """Detects lines in the given edge image using the Hough transform."""
-    lines = cv2.HoughLines(edge_image, 1, np.pi/180, threshold)
-    # Change line representation from [(rho, theta)] to just (rho, theta)
-    lines = [line[0] for line in lines]
+def _detect_lines(edge_image, min_line_length, threshold=50):
+    """Detects lines in the given edge image using the probabilistic Hough
+    transform.
+    """
+    # Segments may bridge the gaps between squares
+    segments = cv2.HoughLinesP(
+        edge_image, 1, _HOUGH_THETA_RESOLUTION, threshold,
+        minLineLength=min_line_length, maxLineGap=30
+    )
+    segments = _to_array(segments)
+    if segments is None:
+        return np.empty((0, 4))
+
+    # Change segment representation from [(x1, y1, x2, y2)] to one array per
+    # coordinate
+    segments = segments.reshape(-1, 4).astype(np.float64)
+    x_1, y_1, x_2, y_2 = segments.T
+
+    # Convert each segment to the (rho, theta) of the line through it, with
+    # theta normal to the segment. The unit normal (-dy, dx) / length gives
+    # cos(theta) and sin(theta) directly, and is flipped where needed so
+    # theta is between 0 and pi as in HoughLines.
+    dx = x_2 - x_1
+    dy = y_2 - y_1
+    lengths = np.hypot(dx, dy)
+    cos_thetas = -dy / lengths
+    sin_thetas = dx / lengths
+    flipped = (sin_thetas < 0) | ((sin_thetas == 0) & (cos_thetas < 0))
+    cos_thetas[flipped] *= -1
+    sin_thetas[flipped] *= -1
+    thetas = np.arctan2(sin_thetas, cos_thetas)
+    rhos = x_1*cos_thetas + y_1*sin_thetas
 
     # Stop rho from wrapping round from positive to negative and theta from
     # wrapping round from pi to 0. This ensures similar lines have similar
     # values when compared.
-    lines = [
-        (rho, theta) if rho >= 0 else (-rho, theta - np.pi)
-        for (rho, theta) in lines
-    ]
+    negative = rhos < 0
+    rhos[negative] *= -1
+    thetas[negative] -= np.pi
+    cos_thetas[negative] *= -1
+    sin_thetas[negative] *= -1
+
+    # Keep the cosine and sine of each line's angle for later use
+    lines = np.stack([rhos, thetas, cos_thetas, sin_thetas], axis=1)
 
     return lines
 
 
+def _lines(rhos, thetas):
+    """Returns an array of lines with the given rhos and thetas."""
+    return np.stack([rhos, thetas, np.cos(thetas), np.sin(thetas)], axis=1)
+
+
 def _draw_lines(image, lines):
     """Returns a copy of the image with the given lines drawn on."""
     image_copy = image.copy()
 
-    for rho, theta in lines:
-        a = np.cos(theta)
-        b = np.sin(theta)
-        x0 = a*rho
-        y0 = b*rho
-        x1 = int(x0 + 1000*(-b))
-        y1 = int(y0 + 1000*a)
-        x2 = int(x0 - 1000*(-b))
-        y2 = int(y0 - 1000*a)
-
+    rhos, _, a, b = lines.T
+    x0 = a*rhos
+    y0 = b*rhos
+    # Two points either side of (x0, y0), far enough to cross the image
+    x1 = x0 + 1000*(-b)
+    y1 = y0 + 1000*a
+    x2 = x0 - 1000*(-b)
+    y2 = y0 - 1000*a
+    end_points = np.stack([x1, y1, x2, y2], axis=1).astype(int)
+
+    for x1, y1, x2, y2 in end_points.tolist():
         cv2.line(image_copy, (x1, y1), (x2, y2), (0, 0, 255), 2)
 
     return image_copy
 
 
-def _is_horizontal(line):
-    """Returns True if line is within 1/36pi of horizontal."""
-    _, theta = line
-    return theta > np.pi*17/36 and theta < np.pi*19/36
+def _is_horizontal(lines):
+    """Returns mask of lines within 1/36pi of horizontal."""
+    thetas = lines[:, _THETA]
+    return (thetas > _HORIZONTAL_THETA_LOW) & (thetas < _HORIZONTAL_THETA_HIGH)
 
 
-def _is_vertical(line):
-    """Returns True if line is within 1/36pi of vertical."""
-    _, theta = line
-    return theta > -np.pi/36 and theta < np.pi/36
+def _is_vertical(lines):
+    """Returns mask of lines within 1/36pi of vertical."""
+    thetas = lines[:, _THETA]
+    return (thetas > _VERTICAL_THETA_LOW) & (thetas < _VERTICAL_THETA_HIGH)
 
 
 def _horizontal_and_vertical_lines(lines):
     """Returns only horizontal and vertical lines of the lines given."""
-    return [
-        line for line in lines
-        if _is_horizontal(line) or _is_vertical(line)
-    ]
+    return lines[_is_horizontal(lines) | _is_vertical(lines)]
 
 
-def _similar(line_1, line_2, rho_threshold=50, theta_threshold=np.pi/18):
-    """Returns True if the two lines are similar enough, False otherwise."""
-    rho_1, theta_1 = line_1
-    rho_2, theta_2 = line_2
-
-    if abs(rho_1 - rho_2) > rho_threshold:
-        return False
-
-    if abs(theta_1 - theta_2) > theta_threshold:
-        return False
-
-    return True
+def _combine_lines(lines, rho_threshold=_RHO_THRESHOLD):
+    """Combines lines that are similar to one another.
 
+    Lines must all be horizontal or vertical. Lines of the same orientation
+    are always within 1/18pi of one another, so they are similar when their
+    rhos are within the threshold, and lines connected through a chain of
+    similar lines are combined together.
+    """
+    return np.concatenate([
+        _combine_parallel_lines(lines[_is_horizontal(lines)], rho_threshold),
+        _combine_parallel_lines(lines[_is_vertical(lines)], rho_threshold)
+    ])
 
-def _average_line(lines):
-    """Combines a group of lines and returns their average."""
-    average_rho = sum(rho for rho, _ in lines) / len(lines)
-    average_theta = sum(theta for _, theta in lines) / len(lines)
-    return average_rho, average_theta
 
+def _combine_parallel_lines(lines, rho_threshold):
+    """Combines parallel lines with rhos within the threshold of another."""
+    if len(lines) == 0:
+        return lines
 
-def _combine_lines(lines):
-    """Combines lines that are similar to one another."""
-    similar_line_groups = [
-        # Convert to tuple to be hashable for set below
-        tuple([line for line in lines if _similar(line, original_line)])
-        for original_line in lines
-    ]
+    lines = lines[np.argsort(lines[:, _RHO], kind="stable")]
+    rhos = lines[:, _RHO]
+    thetas = lines[:, _THETA]
 
-    unique_similar_line_groups = set(similar_line_groups)
+    # Sweeping through the lines in order of rho, a new group starts wherever
+    # the gap from the previous line is too large for them to be similar
+    groups = np.concatenate([[0], np.cumsum(np.diff(rhos) > rho_threshold)])
+    group_sizes = np.bincount(groups)
+    average_rhos = np.bincount(groups, weights=rhos) / group_sizes
+    average_thetas = np.bincount(groups, weights=thetas) / group_sizes
 
-    combined_lines = {
-        _average_line(similar_lines)
-        for similar_lines in unique_similar_line_groups
-    }
-
-    return combined_lines
+    return _lines(average_rhos, average_thetas)
 
 
 def _identify_horizontal_lines(lines):
     """Identifies the horizontal lines and returns them from top to bottom."""
-    horizontal_lines = [line for line in lines if _is_horizontal(line)]
+    horizontal_lines = lines[_is_horizontal(lines)]
     # Rho shows how far away from origin therefore position in top to bottom
-    horizontal_lines.sort(key=lambda line: line[0])
-    return tuple(horizontal_lines)
+    order = np.argsort(horizontal_lines[:, _RHO], kind="stable")
+    return horizontal_lines[order]
 
 
 def _identify_vertical_lines(lines):
     """Identifies the vertical lines and returns them from left to right."""
-    vertical_lines = [line for line in lines if _is_vertical(line)]
+    vertical_lines = lines[_is_vertical(lines)]
     # Rho shows how far away from origin therefore position in left to right
-    vertical_lines.sort(key=lambda line: line[0])
-    return tuple(vertical_lines)
+    order = np.argsort(vertical_lines[:, _RHO], kind="stable")
+    return vertical_lines[order]
 
 
 def _find_centre_lines(lines):
     """Finds the lines passing through the centre of each square"""
-    # Number identifies position from 1 to 4 in top to bottom ordering
+    # Ordered from top to bottom
     horizontal_lines = _identify_horizontal_lines(lines)
     if len(horizontal_lines) != 4:
         return None
-    hor_1, hor_2, hor_3, hor_4 = horizontal_lines
 
-    # Number identifies position from 1 to 4 in left to right ordering
+    # Ordered from left to right
     vertical_lines = _identify_vertical_lines(lines)
     if len(vertical_lines) != 4:
         return None
-    vert_1, vert_2, vert_3, vert_4 = vertical_lines
-
-    top_horizontal = _average_line([hor_1, hor_2])
-    middle_horizontal = _average_line([hor_2, hor_3])
-    bottom_horizontal = _average_line([hor_3, hor_4])
-
-    left_vertical = _average_line([vert_1, vert_2])
-    middle_vertical = _average_line([vert_2, vert_3])
-    right_vertical = _average_line([vert_3, vert_4])
 
-    centre_horizontals = (top_horizontal, middle_horizontal, bottom_horizontal)
-    centre_verticals = (left_vertical, middle_vertical, right_vertical)
+    # Each centre line is the average of the two neighbouring edge lines
+    # either side of it
+    centre_horizontals = _average_neighbouring_lines(horizontal_lines)
+    centre_verticals = _average_neighbouring_lines(vertical_lines)
 
     return (centre_horizontals, centre_verticals)
 
 
-def _intersection(line_1, line_2):
-    """Finds the (x, y) point where two lines intersect."""
-    rho_1, theta_1 = line_1
-    rho_2, theta_2 = line_2
+def _average_neighbouring_lines(lines):
+    """Returns the average of each neighbouring pair of lines."""
+    rhos = (lines[:-1, _RHO] + lines[1:, _RHO]) / 2
+    thetas = (lines[:-1, _THETA] + lines[1:, _THETA]) / 2
+    return _lines(rhos, thetas)
 
-    cos_theta_1 = math.cos(theta_1)
-    sin_theta_1 = math.sin(theta_1)
-    cos_theta_2 = math.cos(theta_2)
-    sin_theta_2 = math.sin(theta_2)
 
-    det = cos_theta_1*sin_theta_2 - sin_theta_1*cos_theta_2
-
-    # det is None when lines are parallel
-    if det is None:
-        return None
+def _find_centres(centre_lines, axis_aligned_tolerance):
+    """Finds the (x, y) centre point of each square from top left to bottom
+    right, or None if any pair of centre lines are parallel.
 
-    x = (sin_theta_2*rho_1 - sin_theta_1*rho_2) / det
-    y = (cos_theta_1*rho_2 - cos_theta_2*rho_1) / det
-
-    return (x, y)
-
-
-def _find_centres(centre_lines):
+    Centre lines tilted from horizontal or vertical by no more than the axis
+    aligned tolerance are treated as exactly horizontal or vertical.
+    """
     horizontal_lines, vertical_lines = centre_lines
 
-    top_left = _intersection(horizontal_lines[0], vertical_lines[0])
-    top_middle = _intersection(horizontal_lines[0], vertical_lines[1])
-    top_right = _intersection(horizontal_lines[0], vertical_lines[2])
+    # Axis aligned horizontal lines are y = rho and vertical lines are x = rho
+    # so no equations need solving
+    horizontal_tilts = np.abs(horizontal_lines[:, _THETA] - np.pi/2)
+    vertical_tilts = np.abs(vertical_lines[:, _THETA])
+    if (np.all(horizontal_tilts <= axis_aligned_tolerance)
+            and np.all(vertical_tilts <= axis_aligned_tolerance)):
+        xs, ys = np.meshgrid(
+            vertical_lines[:, _RHO], horizontal_lines[:, _RHO]
+        )
+        return np.stack([xs.ravel(), ys.ravel()], axis=1)
+
+    # Pair each horizontal line with each vertical line, top to bottom then
+    # left to right
+    line_pairs = np.stack(
+        np.broadcast_arrays(
+            horizontal_lines[:, None, :], vertical_lines[None, :, :]
+        ),
+        axis=2
+    ).reshape(-1, 2, 4)
+
+    # Each line is the set of points where x*cos(theta) + y*sin(theta) = rho
+    # so each pair of lines is a system of two linear equations
+    coefficients = line_pairs[:, :, [_COS_THETA, _SIN_THETA]]
+    rhos = line_pairs[:, :, [_RHO]]
 
-    middle_left = _intersection(horizontal_lines[1], vertical_lines[0])
-    middle = _intersection(horizontal_lines[1], vertical_lines[1])
-    middle_right = _intersection(horizontal_lines[1], vertical_lines[2])
+    # Determinant is zero when lines are parallel
+    if np.any(np.abs(np.linalg.det(coefficients)) < 1e-9):
+        return None
 
-    bottom_left = _intersection(horizontal_lines[2], vertical_lines[0])
-    bottom_middle = _intersection(horizontal_lines[2], vertical_lines[1])
-    bottom_right = _intersection(horizontal_lines[2], vertical_lines[2])
+    centres = np.linalg.solve(coefficients, rhos)[:, :, 0]
 
-    return (
-        top_left, top_middle, top_right,
-        middle_left, middle, middle_right,
-        bottom_left, bottom_middle, bottom_right
-    )
+    return centres
 
 
 def _draw_points(image, points):
@@ -254,74 +413,65 @@ def _draw_points(image, points):
 
 
 def _colours_around_centre(image, centre_point, offset):
-    """Returns a list of colours in a square around a centre point"""
+    """Returns an array of colours in a square around a centre point.
+
+    The square is cut off at the edges of the image, so the array is empty
+    if the square lies entirely outside it.
+    """
+    height, width = image.shape[:2]
     centre_x, centre_y = centre_point
-    left_x = int(centre_x) - offset
-    right_x = int(centre_x) + offset
-    top_y = int(centre_y) - offset
-    bottom_y = int(centre_y) + offset
+    left_x = max(int(centre_x) - offset, 0)
+    right_x = min(int(centre_x) + offset, width - 1)
+    top_y = max(int(centre_y) - offset, 0)
+    bottom_y = min(int(centre_y) + offset, height - 1)
 
-    pixel_colours = [
-        image[y][x]
-        for x in range(left_x, right_x + 1)
-        for y in range(top_y, bottom_y + 1)
-    ]
+    # Checked before slicing, as a negative end would wrap around the image
+    if right_x < left_x or bottom_y < top_y:
+        return np.empty((0, 3), dtype=image.dtype)
 
-    return pixel_colours
+    pixel_colours = image[top_y:bottom_y + 1, left_x:right_x + 1]
+    return pixel_colours.reshape(-1, 3)
 
 
 def _average_colour(colours):
-    """Find the average of a list of colours."""
-    b_average = math.sqrt(sum(b**2 for b, _, _ in colours) / len(colours))
-    g_average = math.sqrt(sum(g**2 for _, g, _ in colours) / len(colours))
-    r_average = math.sqrt(sum(r**2 for _, _, r in colours) / len(colours))
-
-    return (b_average, g_average, r_average)
+    """Find the median of an array of colours, channel by channel.
 
+    The median ignores the few pixels of sticker edge or glare that fall
+    inside the square, which would otherwise pull the average away from the
+    sticker's colour.
+    """
+    return tuple(np.median(colours, axis=0))
 
-def _square_colours(image, centre_points, offset=20):
-    """Finds colour of each square using square around its centre point."""
-    square_colours = tuple(
-        _average_colour(_colours_around_centre(image, centre_point, offset))
-        for centre_point in centre_points
-    )
-
-    return square_colours
 
+def _square_colours(image, centre_points, offset=_SAMPLE_OFFSET):
+    """Finds colour of each square using square around its centre point.
 
-def _colour_similarity(colour_1, colour_2):
-    """Returns the similarity between the colours from 0 (none) to 100 (the
-    same).
+    Returns None if any centre point is too far outside the image for its
+    square to contain any pixels.
     """
-    b_1, g_1, r_1 = colour_1
-    b_2, g_2, r_2 = colour_2
-
-    diff_blue = abs(b_1 - b_2)
-    diff_green = abs(g_1 - g_2)
-    diff_red = abs(r_1 - r_2)
-
-    difference = (diff_blue + diff_green + diff_red) / 3 / 255 * 100
-    similarity = 100 - difference
+    pixel_colours = [
+        _colours_around_centre(image, centre_point, offset)
+        for centre_point in centre_points
+    ]
+    if any(len(colours) == 0 for colours in pixel_colours):
+        return None
 
-    return similarity
+    square_colours = tuple(
+        _average_colour(colours) for colours in pixel_colours
+    )
 
+    return square_colours
 
-def _to_rubiks_colour(colour):
-    """Returns the nearest rubiks cube colour to the given colour."""
-    rubiks_colours = [
-        ('white', (255., 255., 255.)),
-        ('green', (72., 155., 0.)),
-        ('red', (52., 18., 183.)),
-        ('blue', (173., 70., 0.)),
-        ('orange', (0., 88., 255.)),
-        ('yellow', (0., 213., 255.))
-    ]
 
-    similarities = [
-        (rubiks_colour_name, _colour_similarity(colour, rubiks_colour))
-        for (rubiks_colour_name, rubiks_colour) in rubiks_colours
-    ]
+def _to_rubiks_colours(colours):
+    """Returns the nearest rubiks cube colour to each of the given colours."""
+    # Colour channels are from 0 to 255 so whole numbers are precise enough,
+    # and a sum of three differences still fits in 16 bits
+    colours = np.rint(colours).astype(np.int16)
 
-    similarities.sort(key=lambda similarity: similarity[1], reverse=True)
+    # Sum of absolute channel differences between every colour and every
+    # palette colour, smallest difference being the most similar
+    differences = np.abs(colours[:, None, :] - _PALETTE[None, :, :])
+    nearest = differences.sum(axis=-1, dtype=np.int16).argmin(axis=1)
 
-    return similarities[0][0]
+    return tuple(_PALETTE_NAMES[index] for index in nearest)